@@ -30,7 +30,11 @@ from collections import Counter
 
 from headercount.files import HEADER_SUFFIXES
 from headercount.files import iter_input_files
-from headercount.includes import get_includes_lists
+from headercount.includes import IncludeSet
+from headercount.includes import count_deep_includes
+from headercount.includes import count_include_sets
+from headercount.includes import expand_includes_lists
+from headercount.includes import get_flat_includes_lists
 
 
 def get_version():
@@ -38,34 +42,109 @@ def get_version():
     return '1.0.0'
 
 
-def prune_includes_lists(includes_lists, *, headers=False, system=False,
-                         duplicates=False):
-    """Remove information from the list of includes lists.
+def count_includes(includes_lists, *, inclusive=False, headers=True,
+                   system=True, duplicates=True):
+    """Count how many files include each file.
+
+    This filters and counts the includes lists in a single pass.
+    Collections of includes that are shared between several files are
+    only processed once.
 
     Args:
-        includes_lists: A `dict` from file `Path` to lists of
-            `Include`s in that file. This `dict` is modified in-place.
-        headers: Remove all header files (and their includes lists)
-            from `includes_lists`.
-        system: Remove all system-header includes from each list in
-            `includes_lists`.
-        duplicates: For each list in `includes_lists`, remove all
-            duplicate `Include`s.
+        includes_lists: A mapping from file `Path` to collections of
+            `Include`s in that file, as returned by
+            `get_includes_lists`. A `Counter` counts each `Include` as
+            often as its value says.
+        inclusive: If `True`, `includes_lists` must map each file to
+            its direct includes only, as returned by
+            `get_flat_includes_lists`. Indirect includes are then
+            counted as well. With `duplicates`, this is much cheaper
+            than counting the expanded lists, since the includes of
+            each file are never collected.
+        headers: If `False`, the includes of header files are not
+            counted.
+        system: If `False`, system-header includes are not counted.
+        duplicates: If `False`, each `Include` is counted at most once
+            per file.
+
+    Returns:
+        A `Counter` from `Include` to the number of times it was
+        counted.
+    """
+    if inclusive and duplicates:
+        total_count = count_deep_includes(
+            includes_lists,
+            counted=None if headers else _is_source_file,
+            )
+    else:
+        if inclusive:
+            includes_lists = expand_includes_lists(includes_lists,
+                                                   duplicates=False)
+        total_count = _count_includes_lists(includes_lists, headers,
+                                            duplicates)
+    if not system:
+        for include in [include for include in total_count
+                        if include.is_system]:
+            del total_count[include]
+    return total_count
+
+
+def _count_includes_lists(includes_lists, headers, duplicates):
+    """Count the includes lists for `count_includes`.
+
+    Returns:
+        A `Counter` from `Include` to the number of times it was
+        counted, including system headers.
     """
-    if headers:
-        files = list(includes_lists.keys())
-        for file_ in files:
-            if file_.suffix in HEADER_SUFFIXES:
-                del includes_lists[file_]
-    if system or duplicates:
-        for includes in includes_lists.values():
-            filtered = includes
-            if duplicates:
-                filtered = set(filtered)
-            if system:
-                filtered = (include for include in filtered
-                            if not include.is_system())
-            includes[:] = filtered
+    # Files that include each other share the same collection of
+    # includes. Count each collection only once and weight it by the
+    # number of files sharing it.
+    shared = {}
+    for file_, includes in includes_lists.items():
+        if not headers and not _is_source_file(file_):
+            continue
+        entry = shared.get(id(includes))
+        if entry is None:
+            shared[id(includes)] = [includes, 1]
+        else:
+            entry[1] += 1
+    include_sets = []
+    total_count = Counter()
+    for includes, weight in shared.values():
+        if isinstance(includes, IncludeSet):
+            include_sets.append((includes, weight))
+            continue
+        if not duplicates:
+            includes = frozenset(includes)
+        if weight == 1:
+            # `Counter.update` counts an iterable in C; incrementing a
+            # plain `dict` in a Python loop is slower.
+            total_count.update(includes)
+        else:
+            counts = Counter(includes)
+            for include in counts:
+                counts[include] *= weight
+            total_count.update(counts)
+    total_count.update(count_include_sets(include_sets))
+    return total_count
+
+
+def _is_source_file(path):
+    """Return `True` if `path` does not have a header suffix."""
+    return path.suffix not in HEADER_SUFFIXES
+
+
+def _non_negative_int(string):
+    """Convert a command-line argument to a non-negative `int`."""
+    try:
+        value = int(string)
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            'invalid int value: {!r}'.format(string))
+    if value < 0:
+        raise argparse.ArgumentTypeError(
+            'must not be negative: {}'.format(string))
+    return value
 
 
 def get_parser():
@@ -85,6 +164,12 @@ def get_parser():
                         'not recurse into directories whose name '
                         'matches %(metavar)s. If -r is not passed, '
                         'this does not do anything.')
+    inctrl.add_argument('--early-exit-after', type=_non_negative_int,
+                        default=None, metavar='BYTES',
+                        help='Only search the first '
+                        '%(metavar)s bytes of each file for #include '
+                        'directives. This is faster on large files, '
+                        'but misses any directive further down.')
     parser.add_argument('infiles', type=str, nargs='+', metavar='FILE',
                         help='A file to search for include files. If '
                         '%(metavar)s does not have the suffix of a '
@@ -123,24 +208,28 @@ def main(argv):
         exclude=args.exclude,
         exclude_dir=args.exclude_dir
         )
-    # Search each file for a list of included files -- either
-    # direct+indirect includes or direct includes only.
-    includes_lists = get_includes_lists(
+    if args.direct_only and args.no_headers:
+        # Header files are neither counted nor needed to find indirect
+        # includes. Skip them before they are read.
+        infiles = filter(_is_source_file, infiles)
+    # Search each file for a list of directly included files.
+    flat_lists = get_flat_includes_lists(
         infiles,
-        inclusive=not args.direct_only,
+        early_exit_after=args.early_exit_after,
         )
-    prune_includes_lists(
-        includes_lists,
-        system=args.no_system,
-        headers=args.no_headers,
-        duplicates=not args.allow_duplicates,
+    # Count the includes of all files -- either direct+indirect
+    # includes or direct includes only. This is where we get the
+    # actual statistics!
+    total_count = count_includes(
+        flat_lists,
+        inclusive=not args.direct_only,
+        system=not args.no_system,
+        headers=not args.no_headers,
+        duplicates=args.allow_duplicates,
         )
-    # Turn the lists into counters. Note: If we removed duplicates in
-    # the step above, all counters will be `1` at max.
-    counters = (Counter(includes) for includes in includes_lists.values())
-    # Put the counters together. This is where we get the actual
-    # statistics!
-    total_count = sum(counters, Counter())
-    # Print to stdout.
-    for (filename, count) in total_count.most_common():
-        print(count, filename)
+    # Print to stdout. Writing everything at once avoids one `write`
+    # per line when stdout is line-buffered.
+    sys.stdout.write(''.join(
+        '{} {}\n'.format(count, filename)
+        for (filename, count) in total_count.most_common()
+        ))
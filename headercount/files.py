@@ -16,7 +16,11 @@
 
 """Contains the functions for input file collection."""
 
+import os
+import re
+import fnmatch
 from pathlib import Path
+from pathlib import PurePath
 
 HEADER_SUFFIXES = frozenset(['.h', '.H', '.hh', '.hp', '.hpp', '.HPP',
                              '.hxx', '.h++', '.inl', '.tcc', '.icc'])
@@ -26,6 +30,9 @@ SOURCE_SUFFIXES = frozenset(['.c', '.C', '.cc', '.cp', '.cpp', '.CPP',
 
 CPP_SUFFIXES = frozenset.union(HEADER_SUFFIXES, SOURCE_SUFFIXES)
 
+# `CPP_SUFFIXES` without the leading dots.
+_CPP_EXTENSIONS = frozenset(suffix[1:] for suffix in CPP_SUFFIXES)
+
 
 def iter_input_files(args, recursive, exclude, exclude_dir):
     """Iterate over all input files specified by the given arguments.
@@ -34,8 +41,11 @@ def iter_input_files(args, recursive, exclude, exclude_dir):
         args: An iterable of file and directory names.
         recursive: If `True`, recursively search directories for input
             files. If `False`, ignore directory names.
-        exclude: A list of shell-like glob patterns. If an input file
-            name matches any of these patterns, it is ignored.
+        exclude: A list of shell-like glob patterns. If the base name
+            of an input file matches any of these patterns, it is
+            ignored. A pattern that contains a path separator is
+            matched against the end of the file's path instead, as by
+            `PurePath.match`.
         exclude_dir: As `exclude`, but applied to directory names. If
             `recursive` is `False`, this has no effect.
 
@@ -43,7 +53,9 @@ def iter_input_files(args, recursive, exclude, exclude_dir):
         An iterator over all input file names. Input files must have a
         file suffix given in `CPP_SUFFIXES`.
     """
+    exclude = _compile_patterns(exclude)
     if recursive:
+        exclude_dir = _compile_patterns(exclude_dir)
         return _iter_input_files_deep(args, exclude, exclude_dir)
     else:
         return _iter_input_files_flat(args, exclude)
@@ -53,25 +65,91 @@ def _iter_input_files_flat(args, exclude):
     """Non-recursive version of `iter_input_files`."""
     for arg in args:
         path = Path(arg)
+        # Check the name first; it is cheaper than asking the OS.
+        if (path.suffix not in CPP_SUFFIXES or
+                _any_match(path.name, path, exclude)):
+            continue
         if path.is_dir():
             pass
             # log
-        elif path.suffix in CPP_SUFFIXES and not _any_match(path, exclude):
+        else:
             yield path
 
 
 def _iter_input_files_deep(args, exclude, exclude_dir):
     """Recursive version of `iter_input_files`."""
-    stack = [Path(arg) for arg in reversed(args)]
-    while stack:
-        path = stack.pop()
+    for arg in args:
+        path = Path(arg)
         if path.is_dir():
-            if not _any_match(path, exclude_dir):
-                stack.extend(path.iterdir())
-        elif path.suffix in CPP_SUFFIXES and not _any_match(path, exclude):
+            if not _any_match(path.name, path, exclude_dir):
+                yield from _iter_dir_files(arg, exclude, exclude_dir)
+        elif (path.suffix in CPP_SUFFIXES and
+              not _any_match(path.name, path, exclude)):
             yield path
 
 
-def _any_match(path, patterns):
-    """True if any of the given patterns match `path`."""
-    return any(path.match(pattern) for pattern in patterns)
+def _iter_dir_files(dirname, exclude, exclude_dir):
+    """Recursively iterate over the input files in a directory.
+
+    This uses `os.scandir`, whose entries remember the file type that
+    the OS reported while listing the directory. Unlike with
+    `Path.iterdir`, no additional `stat` call is needed per entry.
+    """
+    stack = [dirname]
+    while stack:
+        for entry in os.scandir(stack.pop()):
+            if entry.is_dir():
+                if not _any_match(entry.name, entry.path, exclude_dir):
+                    stack.append(entry.path)
+            elif (_has_cpp_suffix(entry.name) and
+                  not _any_match(entry.name, entry.path, exclude)):
+                yield Path(entry.path)
+
+
+def _has_cpp_suffix(name):
+    """True if the file name `name` has a suffix in `CPP_SUFFIXES`.
+
+    This is equivalent to `PurePath(name).suffix in CPP_SUFFIXES`, but
+    works directly on the string.
+    """
+    dot = name.rfind('.')
+    return dot > 0 and name[dot+1:] in _CPP_EXTENSIONS
+
+
+def _compile_patterns(patterns):
+    """Turn shell-like glob patterns into compiled regular expressions.
+
+    Like `PurePath.match`, matching is case-insensitive on Windows.
+    Patterns that contain a path separator cannot be matched against a
+    base name; they are kept as they are and later passed to
+    `PurePath.match`.
+
+    Returns:
+        A tuple `(name_patterns, path_patterns)` of a list of compiled
+        patterns for base names and a list of patterns for paths.
+    """
+    separators = {'/', os.sep, os.altsep} - {None}
+    flags = re.IGNORECASE if os.name == 'nt' else 0
+    name_patterns = []
+    path_patterns = []
+    for pattern in patterns:
+        if separators.isdisjoint(pattern):
+            name_patterns.append(re.compile(fnmatch.translate(pattern),
+                                            flags))
+        else:
+            path_patterns.append(pattern)
+    return name_patterns, path_patterns
+
+
+def _any_match(name, path, patterns):
+    """True if any of the given patterns match a file or directory.
+
+    Args:
+        name: The base name of the file or directory.
+        path: The path to the file or directory.
+        patterns: A tuple of patterns as returned by
+            `_compile_patterns`.
+    """
+    name_patterns, path_patterns = patterns
+    return (any(pattern.match(name) for pattern in name_patterns) or
+            any(PurePath(path).match(pattern) for pattern in path_patterns))
@@ -16,14 +16,70 @@
 
 """Functions that search files for include directives."""
 
+import io
+import os
+import re
+import mmap
 import itertools
+from collections import Counter
+from collections.abc import Set
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Matches a whole `#include` directive. Group "include" is the included
+# file name, including its quotes or angle brackets. Group "system" is
+# only set if angle brackets are used.
+_INCLUDE_RE = re.compile(
+    rb'^[ \t]*#[ \t]*include[ \t]*'
+    rb'(?P<include>(?P<system><)[^>\n]+>|"[^"\n]+")',
+    re.MULTILINE,
+    )
+
+# Like `_INCLUDE_RE`, but for single lines of text.
+_INCLUDE_LINE_RE = re.compile(
+    r'[ \t]*#[ \t]*include[ \t]*'
+    r'(?P<include>(?P<system><)[^>\n]+>|"[^"\n]+")',
+    )
+
+# Types that `iter_includes` scans as a whole instead of line by line.
+_BUFFER_TYPES = (bytes, bytearray, memoryview, mmap.mmap)
+
+# Cache of all `Include`s created by `iter_includes`, keyed by the raw
+# directive (`bytes` when scanning buffers, `str` when reading lines).
+# Reusing the same object for every occurrence saves memory and lets
+# `dict` and `set` lookups succeed on the identity check instead of
+# comparing strings.
+_INCLUDES = {}
+
+# Flags for opening files with `os.open`. On Windows, `O_BINARY`
+# prevents newline translation.
+_OPEN_FLAGS = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+
+# Flags for opening a directory to pass as `dir_fd` to `os.open`.
+# Where available, `O_PATH` only needs search permission on the
+# directory, just like opening its files by their full path.
+_DIR_OPEN_FLAGS = (getattr(os, 'O_PATH', os.O_RDONLY) |
+                   getattr(os, 'O_DIRECTORY', 0))
+_SUPPORTS_DIR_FD = os.open in os.supports_dir_fd
+
+# Files larger than this many bytes are memory-mapped instead of read.
+_MMAP_THRESHOLD = 64 * 1024
+
+# Number of threads used to read files. Reading is I/O-bound and
+# releases the GIL, so we use more threads than there are CPUs.
+_MAX_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+
+# Number of batches of files per thread. More batches balance the load
+# better, fewer batches cost less scheduling.
+_BATCHES_PER_WORKER = 4
 
 
 class AmbiguousName(Exception):
     """There is more than one matching file for an include directive."""
 
 
-def get_includes_lists(paths, inclusive):
+def get_includes_lists(paths, inclusive, duplicates=True,
+                       early_exit_after=None):
     """For each path in `paths`, return a list of included files.
 
     Args:
@@ -32,83 +88,411 @@ def get_includes_lists(paths, inclusive):
             includes, but also its includes' includes, etc. Only files
             that are passed via `paths` are search recursively. If
             `False`, only direct includes are listed.
+        duplicates: If `True`, an indirect include is counted once for
+            each way in which it is reached. If `False`, each include
+            is listed only once. This has no effect if `inclusive` is
+            `False`.
+        early_exit_after: If not `None`, only the first
+            `early_exit_after` bytes of each file are searched for
+            include directives. See `iter_includes`.
 
     Returns:
         A mapping from a file's path to the files included by said
-        file (either directly or indirectly).
+        file (either directly or indirectly). If `inclusive` is
+        `False`, these are given as a `list`. Otherwise, they are given
+        as a `Counter` from `Include` to the number of times it is
+        included if `duplicates` is `True`, and as an `IncludeSet` if
+        `duplicates` is `False`. Files that include each other share
+        the same `Counter` or `IncludeSet` object.
     """
-    flat_lists = get_flat_includes_lists(paths)
-    return _get_deep_includes_lists(flat_lists) if inclusive else flat_lists
+    flat_lists = get_flat_includes_lists(paths, early_exit_after)
+    if inclusive:
+        return expand_includes_lists(flat_lists, duplicates)
+    return flat_lists
 
 
-def get_flat_includes_lists(paths):
+def get_flat_includes_lists(paths, early_exit_after=None):
     """For each path in `paths`, return a list of included files.
 
+    Args:
+        paths: An iterable of `pathlib.Path`s to search.
+        early_exit_after: If not `None`, only the first
+            `early_exit_after` bytes of each file are searched for
+            include directives. See `iter_includes`.
+
     Returns:
         A mapping from a file's path to the files directly included by
         said file.
+
+    Raises:
+        ValueError if `early_exit_after` is negative.
+    """
+    _check_early_exit_after(early_exit_after)
+    paths = list(paths)
+    # Hand the files to the threads in batches, so that the overhead
+    # of scheduling a task is paid per batch and not per file.
+    batch_size = max(1, len(paths) // (_MAX_WORKERS * _BATCHES_PER_WORKER))
+    batches = [paths[start:start+batch_size]
+               for start in range(0, len(paths), batch_size)]
+    if len(batches) < 2:
+        return dict(zip(paths, _scan_files(paths, early_exit_after)))
+    with ThreadPoolExecutor(max_workers=_MAX_WORKERS) as executor:
+        results = executor.map(_scan_files, batches,
+                               itertools.repeat(early_exit_after))
+        return dict(zip(paths, itertools.chain.from_iterable(results)))
+
+
+def _check_early_exit_after(early_exit_after):
+    """Raise `ValueError` if `early_exit_after` is negative."""
+    if early_exit_after is not None and early_exit_after < 0:
+        raise ValueError('early_exit_after must not be negative: '
+                         '{}'.format(early_exit_after))
+
+
+def _scan_files(paths, early_exit_after):
+    """Return a list of the results of `_scan_file` for each path.
+
+    Where the platform allows it, runs of files in the same directory
+    are opened relative to a descriptor of that directory, so that the
+    kernel resolves the directory's path only once per run. If the
+    directory cannot be opened, its files are opened by their full path
+    as usual.
     """
-    includes = {}
-    for path in paths:
-        with path.open('r') as file_:
-            includes[path] = list(iter_includes(file_))
+    if not _SUPPORTS_DIR_FD:
+        return [_scan_file(path, early_exit_after) for path in paths]
+    results = []
+    for parent, group in itertools.groupby(paths, lambda path: path.parent):
+        group = list(group)
+        dir_fd = None
+        if len(group) > 1:
+            try:
+                dir_fd = os.open(str(parent), _DIR_OPEN_FLAGS)
+            except OSError:
+                pass
+        if dir_fd is None:
+            results.extend(_scan_file(path, early_exit_after)
+                           for path in group)
+            continue
+        try:
+            results.extend(_scan_file(path.name, early_exit_after, dir_fd)
+                           for path in group)
+        finally:
+            os.close(dir_fd)
+    return results
+
+
+def _scan_file(path, early_exit_after=None, dir_fd=None):
+    """Return a list of the include directives in the file at `path`.
+
+    Small files are read in a single call of their known size. Large
+    files are memory-mapped instead, so that the regex can scan the
+    page cache directly instead of a copy of the file. If
+    `early_exit_after` is given, nothing past that many bytes is read.
+    If `dir_fd` is given, `path` is relative to that directory.
+    """
+    fd = os.open(str(path), _OPEN_FLAGS, dir_fd=dir_fd)
+    try:
+        size = os.fstat(fd).st_size
+        if early_exit_after is not None:
+            size = min(size, early_exit_after)
+        if size > _MMAP_THRESHOLD:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as data:
+                return _parse_includes(data, size)
+        return _parse_includes(os.read(fd, size))
+    finally:
+        os.close(fd)
+
+
+def _parse_includes(data, endpos=None):
+    """Return a list of the include directives in a file's contents.
+
+    Args:
+        data: The contents of a C/C++ file as a bytes-like object.
+        endpos: If not `None`, only `data[:endpos]` is searched.
+    """
+    if endpos is None:
+        endpos = len(data)
+    includes = []
+    for match in _INCLUDE_RE.finditer(data, 0, endpos):
+        token = match.group('include')
+        include = _INCLUDES.get(token)
+        if include is None:
+            include = Include.from_directive(
+                token.decode('utf-8', 'replace'),
+                system=match.group('system') is not None,
+                )
+            include = _INCLUDES.setdefault(token, include)
+        includes.append(include)
     return includes
 
 
-def _get_deep_includes_lists(flat_lists):
+def expand_includes_lists(flat_lists, duplicates=True):
+    """Takes the result of `get_flat_includes_lists` and expands it.
 
-    """Takes the result of `get_includes_lists` and expands it."""
+    Files that include each other in a circular manner form a strongly
+    connected component of the include graph. All files in such a
+    component share the same includes, so they are only collected once
+    per component. Because components are visited in reverse
+    topological order, the includes of every included file are complete
+    by the time they are needed.
 
-    include_map = _build_include_map(
-        includes=set(itertools.chain.from_iterable(flat_lists.values())),
-        available_files=flat_lists.keys(),
-        )
+    Internally, files are numbered and all per-file data is kept in
+    lists indexed by these numbers.
 
-    # The dict in which we collect our results.
-    inclusive_lists = {}
-
-    def _iter_direct_includes(path):
-        """Iterate a file's direct includes, skip those not to be searched."""
-        return iter(flat_lists[path])
-
-    def _collect_all_includes(path):
-        """Put together the direct and indirect includes of a file."""
-        direct_includes = flat_lists[path]
-        direct_include_files = (include_map.get(direct_include)
-                                for direct_include in direct_includes)
-        indirect_includes = (inclusive_lists.get(path, [])
-                             for path in direct_include_files
-                             if path)
-        return list(itertools.chain(direct_includes, *indirect_includes))
-
-    # Iterative depth-first search with a stack of iterators.
-    stack = [(path, _iter_direct_includes(path)) for path in flat_lists.keys()]
-    files_being_searched = set(flat_lists.keys())
-    while stack:
-        path, includes_to_handle = stack[-1]
-        include = next(includes_to_handle, None)
-        if include is None:
-            # We have collected all direct+indirect includes for every
-            # direct include of `path`. Now we can put them together.
-            inclusive_lists[path] = _collect_all_includes(path)
-            files_being_searched.remove(path)
-            stack.pop()
+    Args:
+        flat_lists: A mapping from a file's path to the files directly
+            included by it, as returned by `get_flat_includes_lists`.
+        duplicates: See `get_includes_lists`.
+
+    Returns:
+        A mapping from a file's path to the files included by said file
+        either directly or indirectly. See `get_includes_lists`.
+    """
+    paths = list(flat_lists.keys())
+    includes_lists = list(flat_lists.values())
+    includes, include_files = _build_include_graph(paths, includes_lists)
+    components = _iter_strongly_connected_components(include_files)
+    if duplicates:
+        results = _collect_include_counters(components, includes_lists,
+                                            include_files)
+    else:
+        results = _collect_include_sets(components, includes_lists,
+                                        include_files, includes)
+    return dict(zip(paths, results))
+
+
+def count_deep_includes(flat_lists, counted=None):
+    """Count the direct and indirect includes of files with duplicates.
+
+    The result is the same as the sum of the `Counter`s returned by
+    `get_includes_lists` with `inclusive=True` and `duplicates=True`,
+    but the includes of each file are never collected. Instead, each
+    component of the include graph is weighted by the number of include
+    paths that lead to it from a counted file. Its direct includes are
+    then counted that many times.
+
+    Args:
+        flat_lists: A mapping from a file's path to the files directly
+            included by it, as returned by `get_flat_includes_lists`.
+        counted: If not `None`, a function that is called with each
+            path. Only the includes of files for which it returns
+            `True` are counted. All files are still searched for
+            indirect includes.
+
+    Returns:
+        A `Counter` from `Include` to the number of times it is
+        included.
+    """
+    paths = list(flat_lists.keys())
+    includes_lists = list(flat_lists.values())
+    _, include_files = _build_include_graph(paths, includes_lists)
+    components = list(_iter_strongly_connected_components(include_files))
+    # The component that each file belongs to.
+    owners = [-1] * len(paths)
+    for owner, component in enumerate(components):
+        for node in component:
+            owners[node] = owner
+    # The number of include paths from a counted file to each
+    # component. A counted file is a path of length zero to itself.
+    weights = [0] * len(components)
+    for node, path in enumerate(paths):
+        if counted is None or counted(path):
+            weights[owners[node]] += 1
+    total_count = Counter()
+    # Components were found in reverse topological order. Walk them in
+    # topological order, so that each weight is complete before it is
+    # passed on to the included components.
+    for owner in reversed(range(len(components))):
+        weight = weights[owner]
+        if not weight:
             continue
-        # Guess which file this include directive references.
-        include_file = include_map.get(include)
-        is_to_be_searched = (include_file and
-                             include_file not in inclusive_lists and
-                             include_file not in files_being_searched)
-        if is_to_be_searched:
-            # The included file is to be searched and we have not
-            # searched it already _and_ it is not included in a
-            # circular manner. Thus, we descend into it.
-            stack.append((include_file, _iter_direct_includes(include_file)))
-            files_being_searched.add(include_file)
+        for node in components[owner]:
+            for include_file in include_files[node]:
+                if owners[include_file] != owner:
+                    weights[owners[include_file]] += weight
+            for include in includes_lists[node]:
+                total_count[include] += weight
+    return total_count
 
+
+def _build_include_graph(paths, includes_lists):
+    """Find the files that each file includes.
+
+    Args:
+        paths: A list of the paths of all files.
+        includes_lists: A list with the direct includes of each file.
+
+    Returns:
+        A tuple `(includes, include_files)`. `includes` is the set of
+        all includes. `include_files` holds for each file the indices
+        of the files referenced by its include directives. A file that
+        is included twice is listed twice.
+    """
+    includes = set(itertools.chain.from_iterable(includes_lists))
+    include_file_ids = _build_include_map(
+        includes=includes,
+        available_files=paths,
+        )
+    include_files = [
+        [include_file_ids[include] for include in file_includes
+         if include in include_file_ids]
+        for file_includes in includes_lists
+        ]
+    return includes, include_files
+
+
+def _collect_include_counters(components, includes_lists, include_files):
+    """Collect the includes of each component, keeping duplicates.
+
+    The includes are kept as a `Counter` instead of a `list` with
+    repetitions. A header that is reached via many paths may be
+    included an astronomical number of times; such a `list` would not
+    fit into memory.
+
+    Returns:
+        A list with a `Counter` of includes for each file. All files in
+        a component share the same `Counter`.
+    """
+    count = len(includes_lists)
+    # The component that each file belongs to.
+    owners = [-1] * count
+    # The list in which we collect our results.
+    counters = [None] * count
+    for owner, component in enumerate(components):
+        for node in component:
+            owners[node] = owner
+        counter = Counter()
+        for node in component:
+            counter.update(includes_lists[node])
+            for include_file in include_files[node]:
+                if owners[include_file] != owner:
+                    counter.update(counters[include_file])
+        for node in component:
+            counters[node] = counter
+    return counters
+
+
+def _collect_include_sets(components, includes_lists, include_files,
+                          includes):
+    """Collect the includes of each component without duplicates.
+
+    The includes are numbered and each set of them is stored as a bit
+    mask. Merging in the includes of another component is then a single
+    `|` on two integers.
+
+    Returns:
+        A list with an `IncludeSet` of includes for each file. All
+        files in a component, and all files with equal includes, share
+        the same `IncludeSet`.
+    """
+    includes = tuple(includes)
+    ids = {include: index for index, include in enumerate(includes)}
+    count = len(includes_lists)
+    # The masks of files that have not been visited yet are zero. This
+    # includes the other files in the current component, so there is
+    # no need to skip them when merging in the masks of included files.
+    masks = [0] * count
+    # Components with equal includes share a single `IncludeSet`. This
+    # saves memory and lets `count_includes` weigh a shared set instead
+    # of counting it again and again.
+    include_sets = {}
+    # The list in which we collect our results.
+    inclusive_lists = [None] * count
+    for component in components:
+        mask = 0
+        for node in component:
+            for include in includes_lists[node]:
+                mask |= 1 << ids[include]
+            for include_file in include_files[node]:
+                mask |= masks[include_file]
+        include_set = include_sets.get(mask)
+        if include_set is None:
+            include_set = IncludeSet(mask, includes, ids)
+            include_sets[mask] = include_set
+        mask = include_set.mask
+        for node in component:
+            masks[node] = mask
+            inclusive_lists[node] = include_set
     return inclusive_lists
 
 
+def _iter_strongly_connected_components(graph):
+    """Iterate over the strongly connected components of a graph.
+
+    This is an iterative version of Tarjan's algorithm.
+
+    Args:
+        graph: A list that holds for each node the list of its
+            successors. Nodes are the integers from `0` to
+            `len(graph) - 1`.
+
+    Returns:
+        An iterator over lists of nodes. Each list is one strongly
+        connected component. Components are yielded in reverse
+        topological order, i.e. a component is only yielded after all
+        components reachable from it.
+    """
+    count = len(graph)
+    # The order in which nodes were discovered; -1 if not yet.
+    indices = [-1] * count
+    lowlinks = [0] * count
+    # For each node, the position of the next successor to visit.
+    positions = [0] * count
+    on_component_stack = [False] * count
+    component_stack = []
+    next_index = 0
+    for root in range(count):
+        if indices[root] >= 0:
+            continue
+        indices[root] = lowlinks[root] = next_index
+        next_index += 1
+        if not graph[root]:
+            yield [root]
+            continue
+        component_stack.append(root)
+        on_component_stack[root] = True
+        # Iterative depth-first search.
+        stack = [root]
+        while stack:
+            node = stack[-1]
+            successors = graph[node]
+            position = positions[node]
+            if position < len(successors):
+                positions[node] = position + 1
+                successor = successors[position]
+                if indices[successor] < 0:
+                    indices[successor] = lowlinks[successor] = next_index
+                    next_index += 1
+                    if not graph[successor]:
+                        # Most files include no other file from the
+                        # input. Such a leaf is a component of its own,
+                        # so skip the stacks altogether.
+                        yield [successor]
+                        continue
+                    component_stack.append(successor)
+                    on_component_stack[successor] = True
+                    stack.append(successor)
+                elif (on_component_stack[successor] and
+                      indices[successor] < lowlinks[node]):
+                    lowlinks[node] = indices[successor]
+                continue
+            # All successors of `node` have been visited.
+            stack.pop()
+            if stack and lowlinks[node] < lowlinks[stack[-1]]:
+                lowlinks[stack[-1]] = lowlinks[node]
+            if lowlinks[node] == indices[node]:
+                # `node` is the root of a component. Its members are on
+                # top of the component stack.
+                component = []
+                while True:
+                    member = component_stack.pop()
+                    on_component_stack[member] = False
+                    component.append(member)
+                    if member == node:
+                        break
+                yield component
+
+
 def _build_include_map(includes, available_files):
     """Build a map of guesses which include directive maps to which file.
 
@@ -118,43 +502,92 @@ def _build_include_map(includes, available_files):
             could possibly map to.
 
     Returns:
-        A mapping `include => available_file` of all `include`s for
-        which a file could be found.
+        A mapping `include => index` of all `include`s for which a file
+        could be found, where `available_files[index]` is that file.
+        Indices are returned instead of paths so that callers need not
+        hash paths to look the files up again.
 
     Raises:
         `AmbiguousName` if there are several candidates for a given
         `include`.
     """
-    result = {}
-    for include in includes:
-        candidates = [path for path in available_files
-                      if path.name == include.unquoted()]
-        if len(candidates) > 1:
-            raise AmbiguousName(str(include))
-        elif candidates:
-            (result[include],) = candidates
-    return result
-
-
-def iter_includes(file_):
+    # Index the available files by base name once, instead of
+    # searching all of them for every include.
+    index_by_name = {}
+    ambiguous_names = set()
+    for index, path in enumerate(available_files):
+        name = path.name
+        if name in index_by_name:
+            ambiguous_names.add(name)
+        index_by_name[name] = index
+    includes = list(includes)
+    names = list(map(Include.unquoted, includes))
+    # Check all names for ambiguity in a single set intersection.
+    clashes = ambiguous_names.intersection(names)
+    if clashes:
+        include = next(include for include, name in zip(includes, names)
+                       if name in clashes)
+        raise AmbiguousName(str(include))
+    return {include: index
+            for include, index in zip(includes,
+                                      map(index_by_name.get, names))
+            if index is not None}
+
+
+def iter_includes(source, early_exit_after=None):
     """Iterate over include directives in a file.
 
     Args:
-        file_: A file object to read from.
-        ignore_system: If `True`, "#include <...>" lines are ignored.
+        source: The contents of a file as a bytes-like object (e.g.
+            `bytes` or `mmap.mmap`), a file object opened in binary
+            mode, or a file object opened in text mode. Binary data is
+            searched in a single pass with a compiled regular
+            expression and never decoded as a whole. Text files are
+            read line by line.
+        early_exit_after: If not `None`, stop searching after this
+            many bytes (characters for text files). Include directives
+            usually come first in a C/C++ file, so this can skip most
+            of a large file. Any directive that comes later is missed,
+            however.
 
     Returns:
-        An iterator over files included by `file_`. Inclusion is
+        An iterator over files included by `source`. Inclusion is
         determined by searching for #include directives.
+
+    Raises:
+        ValueError if `early_exit_after` is negative.
     """
+    _check_early_exit_after(early_exit_after)
+    if isinstance(source, (io.RawIOBase, io.BufferedIOBase)):
+        source = source.read(early_exit_after)
+    if isinstance(source, _BUFFER_TYPES):
+        endpos = len(source)
+        if early_exit_after is not None:
+            endpos = min(endpos, early_exit_after)
+        return iter(_parse_includes(source, endpos))
+    return _iter_file_includes(source, early_exit_after)
+
+
+def _iter_file_includes(file_, early_exit_after):
+    """Line-by-line version of `iter_includes` for file objects."""
+    consumed = 0
     for line in file_:
-        line = line.lstrip()
-        if not line.startswith('#'):
-            continue
-        parts = line[1:].split()
-        if parts[0] != 'include':
+        if early_exit_after is not None:
+            consumed += len(line)
+            if consumed > early_exit_after:
+                return
+        match = _INCLUDE_LINE_RE.match(line)
+        if match is None:
             continue
-        yield Include(parts[1])
+        token = match.group('include')
+        include = _INCLUDES.get(token)
+        if include is None:
+            include = Include.from_directive(
+                token,
+                system=match.group('system') is not None,
+                )
+            include = _INCLUDES.setdefault(token, include)
+        yield include
 
 
 class Include(str):
@@ -162,8 +595,13 @@ class Include(str):
     """Type representing `#include` directives.
 
     For speed and ease of implementation, this inherits from `str`.
+
+    Attributes:
+        is_system: `True` if the include directive uses angle brackets.
     """
 
+    __slots__ = ('is_system', '_unquoted')
+
     def __new__(cls, *args, **kwargs):
         """Create a new instance.
 
@@ -182,15 +620,139 @@ class Include(str):
         is_regular = result[0] == '"' == result[-1]
         if not (is_system or is_regular):
             raise ValueError('cannot find quotes: '+repr(result))
+        result.is_system = is_system
+        result._unquoted = result[1:-1]
+        return result
+
+    @classmethod
+    def from_directive(cls, string, system):
+        """Create a new instance without checking the quotes.
+
+        This is meant for strings that are already known to be properly
+        quoted, e.g. because they were matched by `_INCLUDE_RE` or
+        `_INCLUDE_LINE_RE`.
+
+        Args:
+            string: The included file name with its quotes.
+            system: `True` if `string` is wrapped in angle brackets.
+        """
+        result = str.__new__(cls, string)
+        result.is_system = system
+        result._unquoted = string[1:-1]
         return result
 
     def __repr__(self):
         return '{}({})'.format(type(self).__name__, str(self))
 
-    def is_system(self):
-        """Return `True` if the include directive uses angle brackets."""
-        return self[0] == '<'
-
     def unquoted(self):
-        """Remove quotes and return the basename of the included file."""
-        return self[1:-1]
+        """Remove quotes and return the basename of the included file.
+
+        The result is computed once when the instance is created.
+        """
+        return self._unquoted
+
+
+class IncludeSet(Set):
+
+    """An immutable set of `Include`s, stored as a bit mask.
+
+    Many of these sets share one numbering of includes. Bit `i` of the
+    mask is set if the `i`-th include of that numbering is in the set.
+
+    Attributes:
+        mask: The bit mask as an `int`.
+        includes: A sequence of all `Include`s in the numbering.
+        ids: A mapping from each element of `includes` to its index.
+    """
+
+    __slots__ = ('mask', 'includes', 'ids')
+
+    def __init__(self, mask, includes, ids):
+        self.mask = mask
+        self.includes = includes
+        self.ids = ids
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        """Used by the `Set` mixin methods to build new sets."""
+        return frozenset(iterable)
+
+    def __contains__(self, include):
+        index = self.ids.get(include)
+        return index is not None and bool(self.mask >> index & 1)
+
+    def __iter__(self):
+        return itertools.compress(self.includes, _iter_bits(self.mask))
+
+    def __len__(self):
+        return bin(self.mask).count('1')
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, set(self))
+
+
+def count_include_sets(include_sets):
+    """Count how many of the given `IncludeSet`s contain each `Include`.
+
+    The sets are added up as bit masks into a bit-sliced counter, so
+    they never have to be taken apart one by one.
+
+    Args:
+        include_sets: An iterable of pairs `(include_set, weight)`.
+            Each `include_set` is counted `weight` times.
+
+    Returns:
+        A `Counter` from `Include` to the number of sets containing it.
+    """
+    # For each numbering of includes, a list of bit planes: Bit `i` of
+    # `planes[j]` is bit `j` of the count of the `i`-th include.
+    tallies = {}
+    for include_set, weight in include_sets:
+        _, planes = tallies.setdefault(id(include_set.includes),
+                                       (include_set.includes, []))
+        plane = 0
+        while weight:
+            if weight & 1:
+                _add_to_planes(planes, include_set.mask, plane)
+            weight >>= 1
+            plane += 1
+    total_count = Counter()
+    for includes, planes in tallies.values():
+        counts = [0] * len(includes)
+        for plane, mask in enumerate(planes):
+            for index in itertools.compress(range(len(includes)),
+                                            _iter_bits(mask)):
+                counts[index] += 1 << plane
+        total_count.update({include: count
+                            for include, count in zip(includes, counts)
+                            if count})
+    return total_count
+
+
+def _add_to_planes(planes, carry, plane):
+    """Add `1 << plane` to each count selected by the bit mask `carry`.
+
+    Args:
+        planes: A bit-sliced counter as used by `count_include_sets`.
+            It is modified in-place.
+        carry: A bit mask of the counts to increase.
+        plane: The significance of the increment.
+    """
+    while carry:
+        if plane >= len(planes):
+            planes.extend([0] * (plane - len(planes)))
+            planes.append(carry)
+            return
+        current = planes[plane]
+        planes[plane] = current ^ carry
+        carry &= current
+        plane += 1
+
+
+def _iter_bits(mask):
+    """Iterate over the bits of `mask` as bools, lowest bit first.
+
+    The iterator yields a few extra `False`s at the end, which is
+    harmless for `itertools.compress`.
+    """
+    return map('1'.__eq__, reversed(bin(mask)))
@@ -29,7 +29,7 @@ useful when debugging long compile times of medium-sized projects.
 setup(
     name='headercount',
     version=get_version(),
-    python_requires='>=3.4',
+    python_requires='>=3.5',
     packages=['headercount'],
     entry_points={
         'console_scripts': [
@@ -50,9 +50,6 @@ setup(
         'License :: OSI Approved :: Apache Software License',
         'Natural Language :: English',
         'Operating System :: OS Independent',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.4',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',